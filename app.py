@@ -1,6 +1,9 @@
 import os
-import requests
-from flask import Flask, request, Response, jsonify
+import hmac
+import functools
+import httpx
+import orjson
+from quart import Quart, request, Response
 from dotenv import load_dotenv
 import logging
 from key_manager import key_manager  # Import the shared instance
@@ -18,48 +21,86 @@ PROXY_HOST = os.getenv("PROXY_HOST", "0.0.0.0")
 PROXY_PORT = int(os.getenv("PROXY_PORT", 5000))
 DEFAULT_MODEL = "gemini-pro"  # Default model if none is specified
 GEMINI_API_VERSION = os.getenv("GEMINI_API_VERSION", "v1beta") # Default API version
+UPSTREAM_TIMEOUT = 180  # Seconds to wait on each connect/read from Gemini before giving up
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 256))  # Concurrent upstream connections per worker
+UPSTREAM_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_KEEPALIVE_CONNECTIONS", 64))  # Idle connections kept open for reuse
 
 if not GEMINI_API_BASE_URL:
     raise ValueError("GEMINI_API_BASE_URL environment variable not set.")
 if not GATEWAY_API_KEY:
     raise ValueError("GATEWAY_API_KEY environment variable not set.")
 
-app = Flask(__name__)
+# Full Authorization header value clients must send, compared as bytes
+EXPECTED_AUTH_HEADER = f"Bearer {GATEWAY_API_KEY}".encode()
+# Everything in the target URL before the model name
+GEMINI_TARGET_URL_PREFIX = f"{GEMINI_API_BASE_URL.rstrip('/')}/{GEMINI_API_VERSION}/"
+# Headers that must not be copied between the client and Gemini (lowercase)
+REQUEST_EXCLUDED_HEADERS = frozenset(('host', 'authorization', 'content-length', 'content-type'))
+# Date and Server are dropped from responses since Uvicorn adds its own
+RESPONSE_EXCLUDED_HEADERS = frozenset(('content-encoding', 'transfer-encoding', 'connection', 'content-length', 'date', 'server'))
+
+app = Quart(__name__)
+# No cap on total response time, so long streamed completions aren't cut off;
+# a stalled upstream is caught by the per-read UPSTREAM_TIMEOUT instead
+app.config["RESPONSE_TIMEOUT"] = None
+# Quart caps request bodies at 16 MiB by default; long chat histories can exceed that
+app.config["MAX_CONTENT_LENGTH"] = None
+
+# Shared upstream client, created once the event loop is running
+http_client = None
+
+@app.before_serving
+async def startup():
+    """Creates the shared HTTP client used for all upstream requests."""
+    global http_client
+    http_client = httpx.AsyncClient(
+        http2=True,  # Multiplex concurrent requests over a single TLS connection
+        timeout=UPSTREAM_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=60,
+        ),
+    )
+
+@app.after_serving
+async def shutdown():
+    """Closes the shared HTTP client and its pooled connections."""
+    await http_client.aclose()
 
 # --- Helper Functions ---
 
+def json_response(payload, status=200):
+    """Serializes payload with orjson into an application/json response."""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
 def validate_request(incoming_request):
     """Checks if the incoming request uses the correct gateway API key via Bearer token."""
-    auth_header = incoming_request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return False
-    provided_key = auth_header.split(' ')[1]
-    return provided_key == GATEWAY_API_KEY
+    auth_header = incoming_request.headers.get('Authorization', '')
+    # Constant-time comparison so the key can't be guessed from response timing
+    return hmac.compare_digest(auth_header.encode(), EXPECTED_AUTH_HEADER)
 
-def construct_gemini_request_body(data):
+def construct_gemini_request_body(raw_body):
     """
     Constructs the request body for the Gemini API, allowing model specification.
     Handles both chat and non-chat formats.
     """
     try:
-        json_data = request.get_json()
+        json_data = orjson.loads(raw_body) if raw_body else None
         if not json_data:
             return {"error": "No JSON data provided in the request"}, 400, DEFAULT_MODEL
 
         model_name = json_data.get("model", DEFAULT_MODEL)  # Get model from request, default to gemini-pro
+        if not isinstance(model_name, str):
+            return {"error": "Model must be a string"}, 400, DEFAULT_MODEL
 
         if "messages" in json_data:
-            messages = json_data["messages"]
-            gemini_messages = []
-            for message in messages:
-                role = message.get("role", "user")
-                content = message.get("content", "")
-                gemini_messages.append({
-                    "role": role,
-                    "parts": [{"text": content}]
-                })
+            # One comprehension over the history; this is the hot loop for long chats
             gemini_request_body = {
-                "contents": gemini_messages
+                "contents": [
+                    {"role": message.get("role", "user"), "parts": [{"text": message.get("content", "")}]}
+                    for message in json_data["messages"]
+                ]
             }
         else:
             prompt_text = json_data.get("prompt")
@@ -74,95 +115,130 @@ def construct_gemini_request_body(data):
         logging.error(f"Error constructing Gemini request body: {e}")
         return {"error": f"Invalid request format: {e}"}, 400, DEFAULT_MODEL
 
+@functools.lru_cache(maxsize=64)
+def gemini_target_url(model_name):
+    """Returns the generateContent URL for a model; clients only ever use a handful."""
+    return f"{GEMINI_TARGET_URL_PREFIX}{model_name}:generateContent"
+
+def parse_retry_after(headers):
+    """Returns the Retry-After delay in seconds, or None if absent or not numeric."""
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None  # HTTP-date form; fall back to the default cooldown
+
+async def stream_upstream_response(upstream_response):
+    """Yields the upstream body and always releases its connection back to the pool."""
+    try:
+        # No chunk_size: forward each chunk as soon as it arrives instead of
+        # holding streamed tokens back until a fixed-size buffer fills up
+        async for chunk in upstream_response.aiter_bytes():
+            yield chunk
+    finally:
+        await upstream_response.aclose()
+
 # --- Routes ---
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
-def forward_request(path):
+async def forward_request(path):
     """Catches all requests and forwards them to the Gemini API."""
     # 1. Authentication
     if not validate_request(request):
         auth_header = request.headers.get('Authorization')
         logging.warning(f"Unauthorized attempt. Header: '{auth_header}'")
-        return jsonify({
+        return json_response({
             "error": {
                 "message": "Incorrect API key provided.",
                 "type": "invalid_request_error",
                 "param": None,
                 "code": "invalid_api_key"
             }
-        }), 401
+        }, 401)
 
     # 2. Get current Gemini key
-    gemini_api_key = key_manager.get_key()
-    key_short = gemini_api_key[:4] + "..." + gemini_api_key[-4:]
-    logging.info(f"Using Gemini API key: {key_short} for request path: {path}")
+    key_idx, gemini_api_key, key_short = key_manager.get_current()
+    logging.info("Using Gemini API key: %s for request path: %s", key_short, path)
 
     # 3. Prepare the request for Gemini
-    gemini_request_body, status_code, model_name = construct_gemini_request_body(request.get_data())
+    # Don't cache the raw client bytes on the request, so they can be freed once parsed
+    gemini_request_body, status_code, model_name = construct_gemini_request_body(await request.get_data(cache=False))
     if status_code != 200:
-        return jsonify(gemini_request_body), status_code
+        return json_response(gemini_request_body, status_code)
 
     # Construct the target URL with the dynamic model name and API version
-    target_url = f"{GEMINI_API_BASE_URL.rstrip('/')}/{GEMINI_API_VERSION}/{model_name}:generateContent"
-
-    # Copy query parameters
-    forward_params = request.args.copy()
-    forward_params['key'] = gemini_api_key
-
-    # Copy headers, removing Host and the original Authorization
-    forward_headers = {
-        key: value for key, value in request.headers.items()
-        if key.lower() not in ['host', 'authorization', 'content-length']
-    }
+    target_url = gemini_target_url(model_name)
+
+    # Copy query parameters, only building a new dict when there are any to copy
+    if request.args:
+        forward_params = dict(request.args)
+        forward_params['key'] = gemini_api_key
+    else:
+        forward_params = {'key': gemini_api_key}
+
+    # Copy headers as (name, value) pairs, removing Host and the original Authorization
+    forward_headers = [
+        (key, value) for key, value in request.headers.items()
+        if key.lower() not in REQUEST_EXCLUDED_HEADERS
+    ]
+    forward_headers.append(('Content-Type', 'application/json'))
 
     # 4. Make the request to Gemini
     try:
-        gemini_response = requests.post(
-            url=target_url,
+        upstream_request = http_client.build_request(
+            "POST",
+            target_url,
             headers=forward_headers,
             params=forward_params,
-            json=gemini_request_body,
-            stream=True,
-            timeout=180
+            content=orjson.dumps(gemini_request_body),
         )
+        gemini_response = await http_client.send(upstream_request, stream=True)
         gemini_response.raise_for_status()
 
-    except requests.exceptions.RequestException as e:
-        status_code = e.response.status_code if e.response else 500
-        error_body = e.response.content if e.response else b'{"error": "Upstream connection error"}'
-        error_headers = e.response.headers if e.response else {}
+    except httpx.HTTPStatusError as e:
+        status_code = e.response.status_code
+        error_headers = e.response.headers
         logging.error(f"Error forwarding request to Gemini ({status_code}): {e}")
-        if e.response:
-            logging.error(f"Gemini Response Body: {error_body.decode('utf-8', errors='ignore')}")
 
         if status_code == 429 or status_code == 503:
-            logging.warning(f"Rate limit detected (Status {status_code}) with key {key_short}.")
-            key_manager.rotate_key()
-
-        excluded_headers = ['content-encoding', 'transfer-encoding', 'connection']
-        response_headers = [(k, v) for k, v in error_headers.items() if k.lower() not in excluded_headers]
+            logging.warning("Rate limit detected (Status %s) with key %s.", status_code, key_short)
+            key_manager.rotate_key(key_idx, parse_retry_after(error_headers))
+
+        try:
+            error_body = await e.response.aread()
+        except httpx.RequestError as read_error:
+            logging.error(f"Error reading Gemini error response (500): {read_error}")
+            return json_response({"error": "Upstream connection error"}, 500)
+        finally:
+            await e.response.aclose()
+        logging.error(f"Gemini Response Body: {error_body.decode('utf-8', errors='ignore')}")
+
+        response_headers = [(k, v) for k, v in error_headers.items() if k.lower() not in RESPONSE_EXCLUDED_HEADERS]
         return Response(error_body, status=status_code, headers=response_headers)
 
-    # 5. Stream the successful response back to the client
-    excluded_headers = ['content-encoding', 'transfer-encoding', 'connection']
-    response_headers = [(k, v) for k, v in gemini_response.headers.items() if k.lower() not in excluded_headers]
+    except httpx.RequestError as e:
+        logging.error(f"Error forwarding request to Gemini (500): {e}")
+        return json_response({"error": "Upstream connection error"}, 500)
 
-    if 'content-type' in gemini_response.headers:
-        response_headers.append(('Content-Type', gemini_response.headers['content-type']))
+    # 5. Stream the successful response back to the client
+    response_headers = [(k, v) for k, v in gemini_response.headers.items() if k.lower() not in RESPONSE_EXCLUDED_HEADERS]
 
-    return Response(gemini_response.iter_content(chunk_size=8192),
+    return Response(stream_upstream_response(gemini_response),
                     status=gemini_response.status_code,
                     headers=response_headers)
 
 @app.route('/health', methods=['GET'])
-def health_check():
+async def health_check():
     """Simple health check endpoint."""
-    return jsonify({"status": "ok", "using_gemini_endpoint": True}), 200
+    return json_response({"status": "ok", "using_gemini_endpoint": True})
 
 # --- Run the App ---
 if __name__ == '__main__':
     logging.info(f"Starting Gemini Proxy on {PROXY_HOST}:{PROXY_PORT}")
     logging.info(f"Forwarding to: {GEMINI_API_BASE_URL}")
     logging.info(f"Expecting Gateway Key: {GATEWAY_API_KEY[:4]}... (Check Authorization: Bearer header)")
-    app.run(host=PROXY_HOST, port=PROXY_PORT, threaded=True)
+    import uvicorn
+    uvicorn.run(app, host=PROXY_HOST, port=PROXY_PORT)
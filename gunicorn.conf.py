@@ -0,0 +1,17 @@
+# gunicorn.conf.py - Production server settings, picked up by `gunicorn app:app`
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('PROXY_HOST', '0.0.0.0')}:{os.getenv('PROXY_PORT', 5000)}"
+
+# One async worker handles many concurrent requests on its own. Key rotation
+# state (current key, cooldowns) lives in each process and isn't shared, so
+# every extra worker starts on the first key and rate-limits it independently.
+# Only raise WEB_CONCURRENCY if a single worker is CPU-bound.
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Keep idle client connections open so clients can reuse them between requests
+keepalive = 75
@@ -1,7 +1,7 @@
 # key_manager.py - Remains the same
 import os
 import threading
-from itertools import cycle
+import time
 from dotenv import load_dotenv
 import logging
 
@@ -13,24 +13,49 @@ class ApiKeyManager:
         keys_str = os.getenv("GEMINI_API_KEYS")
         if not keys_str:
             raise ValueError("GEMINI_API_KEYS environment variable not set or empty.")
-        self.api_keys = [key.strip() for key in keys_str.split(',') if key.strip()]
-        if not self.api_keys:
+        self._keys = tuple(key.strip() for key in keys_str.split(',') if key.strip())
+        if not self._keys:
             raise ValueError("No valid API keys found in GEMINI_API_KEYS.")
-        logging.info(f"Loaded {len(self.api_keys)} API keys.")
-        self._key_cycler = cycle(self.api_keys)
-        self._current_key = next(self._key_cycler)
+        logging.info(f"Loaded {len(self._keys)} API keys.")
+        # Seconds a rate-limited key is skipped when upstream doesn't send Retry-After
+        self._key_cooldown = float(os.getenv("KEY_COOLDOWN", 60))
+        # Shortened forms for logging, computed once instead of on every request
+        self._shorts = tuple(key[:4] + "..." + key[-4:] for key in self._keys)
+        self._cooldowns = [0.0] * len(self._keys)  # monotonic time each key is usable again
+        self._idx = 0  # Only ever reassigned whole, under the lock
         self._lock = threading.Lock()
 
-    def get_key(self):
-        with self._lock:
-            return self._current_key
+    def get_current(self):
+        """Returns (index, key, short key) for the key to use; pass the index back to rotate_key()."""
+        # A single attribute read is atomic, so readers don't need the lock
+        idx = self._idx
+        return idx, self._keys[idx], self._shorts[idx]
+
+    def _next_available_index(self, now):
+        """Returns the next key index after the current one that isn't cooling down."""
+        count = len(self._keys)
+        for step in range(1, count + 1):
+            idx = (self._idx + step) % count
+            if self._cooldowns[idx] <= now:
+                return idx
+        # Every key is cooling down; use whichever one frees up first
+        return min(range(count), key=self._cooldowns.__getitem__)
 
-    def rotate_key(self):
+    def rotate_key(self, failed_idx, retry_after=None):
         with self._lock:
-            old_key_short = self._current_key[:4] + "..." + self._current_key[-4:]
-            self._current_key = next(self._key_cycler)
-            new_key_short = self._current_key[:4] + "..." + self._current_key[-4:]
-            logging.warning(f"Rotating API key from {old_key_short} to {new_key_short} due to rate limit.")
-            return self._current_key
+            if self._idx != failed_idx:
+                # Another request already rotated away from this key
+                return self._idx
+            now = time.monotonic()
+            cooldown = retry_after if retry_after is not None else self._key_cooldown
+            self._cooldowns[failed_idx] = now + cooldown
+            new_idx = self._next_available_index(now)
+            if new_idx == failed_idx:
+                # Every other key is cooling for longer; stay on this one
+                return failed_idx
+            self._idx = new_idx
+            logging.warning("Rotating API key from %s to %s due to rate limit.",
+                            self._shorts[failed_idx], self._shorts[new_idx])
+            return new_idx
 
 key_manager = ApiKeyManager()
\ No newline at end of file